@@ -1,14 +1,32 @@
 from __future__ import annotations
 
+import gzip
 import hashlib
+import io
 import json
+import mmap
 import os
+import re
+import stat
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from fnmatch import fnmatch
+from fnmatch import translate
+from functools import lru_cache
+from json.encoder import encode_basestring_ascii
 from pathlib import Path
-from typing import Iterable
+from typing import TYPE_CHECKING, Callable, Iterator
 
-import requests
+if TYPE_CHECKING:
+    import requests
+
+try:  # Optional C-accelerated JSON; stdlib json is the fallback.
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
 
 DEFAULT_EXCLUDES = {
     ".git",
@@ -45,26 +63,98 @@ REFINE_SYSTEM_PROMPT = (
 # ---------------------------------------------------------------------------
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class FileChunk:
-    path: Path
+    path: str  # POSIX-style path relative to the scanned base directory
     content: str
 
 
-def _matches_any(path: Path, patterns: Iterable[str]) -> bool:
-    path_str = path.as_posix()
+@lru_cache(maxsize=64)
+def _compile_patterns(patterns: tuple[str, ...]) -> re.Pattern[str] | None:
+    """Compile glob *patterns* into a single alternation regex.
+
+    Patterns starting with ``**/`` are expanded into both the prefixed and the
+    bare form so that ``**/*.py`` also matches top-level files, mirroring the
+    old per-pattern fnmatch fallback.
+    """
+    expanded: list[str] = []
     for pattern in patterns:
-        if fnmatch(path_str, pattern):
-            return True
-        if pattern.startswith("**/") and fnmatch(path_str, pattern[3:]):
-            return True
-    return False
+        expanded.append(pattern)
+        if pattern.startswith("**/"):
+            expanded.append(pattern[3:])
+    if not expanded:
+        return None
+    return re.compile("|".join(f"(?:{translate(p)})" for p in expanded))
+
+
+_GLOB_META_RE = re.compile(r"[*?\[]")
+
+
+def _split_excludes(patterns: set[str]) -> tuple[frozenset[str], tuple[str, ...]]:
+    """Partition exclude *patterns* into literal names and real globs.
+
+    Literals (no glob metacharacters) can be tested against path parts with a
+    cheap set lookup, which culls the vast majority of candidates before the
+    regex matcher ever runs.
+    """
+    literals = frozenset(p for p in patterns if not _GLOB_META_RE.search(p))
+    globs = tuple(sorted(patterns - literals))
+    return literals, globs
+
 
+def _read_file(path: str) -> str:
+    with open(path, "rb") as f:
+        return f.read().decode("utf-8", errors="ignore")
 
-def _is_excluded(rel_path: Path, exclude_patterns: Iterable[str]) -> bool:
-    if _matches_any(rel_path, exclude_patterns):
-        return True
-    return any(part in exclude_patterns for part in rel_path.parts)
+
+def _walk(base_path: Path, literal_excludes: frozenset[str]) -> Iterator[tuple[os.DirEntry, str]]:
+    """Yield ``(entry, rel_path)`` pairs for files under *base_path*.
+
+    Directories whose name is a literal exclude are pruned at walk time, so
+    an excluded tree (``.git``, ``node_modules``, ...) costs a single name
+    check instead of a stat per descendant. ``rel_path`` is built from a
+    running prefix string, avoiding ``Path.relative_to`` per entry.
+    """
+    stack: list[tuple[str, str]] = [(str(base_path), "")]
+    while stack:
+        dir_path, rel_prefix = stack.pop()
+        try:
+            with os.scandir(dir_path) as it:
+                entries = sorted(it, key=lambda e: e.name)
+        except OSError:
+            continue
+        for entry in entries:
+            if entry.name in literal_excludes:
+                continue
+            rel_str = rel_prefix + entry.name
+            if entry.is_dir(follow_symlinks=False):
+                stack.append((entry.path, rel_str + "/"))
+            else:
+                yield entry, rel_str
+
+
+_COLLECT_MEMO: dict[tuple, list[FileChunk]] = {}
+
+
+def _tree_fingerprint(base_path: Path) -> tuple | None:
+    """Coarse change fingerprint: root mtime plus first-level child stats.
+
+    Deliberately cheap — it catches files being added, removed or touched at
+    the top level and any directory mtime bump, not deep in-place edits that
+    preserve every first-level mtime.
+    """
+    try:
+        fingerprint: list = [os.stat(base_path).st_mtime_ns]
+        with os.scandir(base_path) as it:
+            for entry in sorted(it, key=lambda e: e.name):
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+                fingerprint.append((entry.name, st.st_mtime_ns, st.st_size))
+        return tuple(fingerprint)
+    except OSError:
+        return None
 
 
 def collect_files(
@@ -73,35 +163,108 @@ def collect_files(
     exclude: list[str] | None = None,
     max_file_bytes: int = 120_000,
     max_total_bytes: int = 400_000,
+    memoize: bool = False,
 ) -> list[FileChunk]:
     include_patterns = include or DEFAULT_INCLUDES
     exclude_patterns = set(exclude or []) | DEFAULT_EXCLUDES
 
-    collected: list[FileChunk] = []
-    total_bytes = 0
-
-    for path in base_path.rglob("*"):
-        rel_path = path.relative_to(base_path)
-
-        if _is_excluded(rel_path, exclude_patterns):
-            continue
-
-        if path.is_dir():
-            continue
+    memo_key = None
+    if memoize:
+        fingerprint = _tree_fingerprint(base_path)
+        if fingerprint is not None:
+            memo_key = (
+                str(base_path),
+                tuple(include_patterns),
+                tuple(sorted(exclude_patterns)),
+                max_file_bytes,
+                max_total_bytes,
+                fingerprint,
+            )
+            memoized = _COLLECT_MEMO.get(memo_key)
+            if memoized is not None:
+                return list(memoized)
 
-        if not _matches_any(rel_path, include_patterns):
-            continue
+    literal_excludes, glob_excludes = _split_excludes(exclude_patterns)
 
-        size = path.stat().st_size
-        if size > max_file_bytes:
-            continue
+    include_re = _compile_patterns(tuple(include_patterns))
+    exclude_re = _compile_patterns(glob_excludes)
 
-        if total_bytes + size > max_total_bytes:
-            break
+    # Pass 1: filter serially (cheap) and collect accepted paths under the
+    # byte budget, so the read pass knows the exact work list up front.
+    accepted: list[tuple[str, str]] = []  # (absolute path, relative path)
+    total_bytes = 0
 
-        content = path.read_text(encoding="utf-8", errors="ignore")
-        collected.append(FileChunk(path=rel_path, content=content))
-        total_bytes += size
+    if include_patterns and all(
+        not _GLOB_META_RE.search(p) and not os.path.isabs(p) and ".." not in p.split("/")
+        for p in include_patterns
+    ):
+        # Every include names one exact relative path (fnmatch wildcards
+        # always cross "/", so any wildcard forces a recursive walk): stat
+        # the named files directly instead of walking the whole tree.
+        # Absolute or ".."-traversing includes fall through to the walk,
+        # which matches them against base-relative paths and so (correctly)
+        # never yields anything outside base_path.
+        for rel_str in dict.fromkeys(include_patterns):
+            if not literal_excludes.isdisjoint(rel_str.split("/")):
+                continue
+            if exclude_re is not None and exclude_re.match(rel_str):
+                continue
+            full_path = base_path / rel_str
+            try:
+                st = os.stat(full_path)
+            except OSError:
+                continue
+            if not stat.S_ISREG(st.st_mode) or st.st_size > max_file_bytes:
+                continue
+            if total_bytes + st.st_size > max_total_bytes:
+                break
+            accepted.append((str(full_path), rel_str))
+            total_bytes += st.st_size
+    else:
+        for entry, rel_str in _walk(base_path, literal_excludes):
+            if exclude_re is not None and exclude_re.match(rel_str):
+                continue
+
+            if include_re is None or not include_re.match(rel_str):
+                continue
+
+            try:
+                st = entry.stat()
+            except OSError:
+                # Dangling symlink or a file that vanished mid-walk.
+                continue
+            if not stat.S_ISREG(st.st_mode):
+                # e.g. a symlink to a directory, or a fifo/socket.
+                continue
+            size = st.st_size
+            if size > max_file_bytes:
+                continue
+
+            if total_bytes + size > max_total_bytes:
+                break
+
+            accepted.append((entry.path, rel_str))
+            total_bytes += size
+
+    # Pass 2: file reads release the GIL, so issue them concurrently and
+    # reassemble in the original order. The filter pass fixed the result
+    # length, so the list is allocated once and filled by index.
+    collected: list[FileChunk] = [None] * len(accepted)
+    paths = [path for path, _ in accepted]
+
+    if len(paths) <= 16:
+        # Pool setup costs more than it saves for a handful of files.
+        for i, path in enumerate(paths):
+            collected[i] = FileChunk(path=accepted[i][1], content=_read_file(path))
+    elif paths:
+        with ThreadPoolExecutor(max_workers=min(32, len(paths))) as pool:
+            for i, content in enumerate(pool.map(_read_file, paths)):
+                collected[i] = FileChunk(path=accepted[i][1], content=content)
+
+    if memo_key is not None:
+        if len(_COLLECT_MEMO) >= 32:
+            _COLLECT_MEMO.clear()  # coarse bound; entries are cheap to rebuild
+        _COLLECT_MEMO[memo_key] = list(collected)
 
     return collected
 
@@ -111,16 +274,34 @@ def collect_files(
 # ---------------------------------------------------------------------------
 
 
-def build_prompt(files: list[FileChunk], focus: str | None) -> str:
+def _prompt_parts(files: list[FileChunk], focus: str | None) -> list[str]:
     header = "You are an expert software reviewer. Analyze the following code."
     if focus:
         header += f" Focus on: {focus}."
 
-    blocks = [header, "Provide findings with severity and suggested fixes."]
+    parts = [header, "\n", "Provide findings with severity and suggested fixes."]
     for chunk in files:
-        blocks.append(f"\nFile: {chunk.path}\n" + chunk.content)
+        parts.extend(("\n\nFile: ", chunk.path, "\n", chunk.content))
+
+    return parts
 
-    return "\n".join(blocks)
+
+def build_prompt(files: list[FileChunk], focus: str | None) -> str:
+    return "".join(_prompt_parts(files, focus))
+
+
+def build_prompt_keyed(files: list[FileChunk], focus: str | None) -> tuple[str, str]:
+    """Build the prompt and its cache digest in one go.
+
+    Hashing the still-separate fragments avoids a second full pass over the
+    joined multi-hundred-KB string; the digest is identical to
+    :func:`prompt_digest` of the returned prompt.
+    """
+    parts = _prompt_parts(files, focus)
+    hasher = _PromptHasher()
+    for part in parts:
+        hasher.update(part)
+    return "".join(parts), hasher.hexdigest()
 
 
 # ---------------------------------------------------------------------------
@@ -128,33 +309,131 @@ def build_prompt(files: list[FileChunk], focus: str | None) -> str:
 # ---------------------------------------------------------------------------
 
 
+class _PromptHasher:
+    """Hash a prompt for cache keying, fed fragment by fragment.
+
+    Trailing whitespace is stripped per line (and off the very end) as the
+    text streams through, so the digest only ever sees the normalised form
+    without materialising it. Lines may span fragment boundaries; the piece
+    after the last newline is carried over until the next fragment or
+    ``hexdigest``.
+    """
+
+    def __init__(self) -> None:
+        self._hash = hashlib.blake2b(digest_size=16)
+        self._tail = ""
+        self._deferred = ""
+        self._first = True
+
+    def update(self, fragment: str) -> None:
+        text = self._tail + fragment
+        segments = text.split("\n")
+        self._tail = segments.pop()
+        for segment in segments:
+            self._emit(segment)
+
+    def _emit(self, segment: str) -> None:
+        segment = segment.rstrip()
+        piece = segment if self._first else "\n" + segment
+        self._first = False
+        if segment:
+            self._hash.update((self._deferred + piece).encode("utf-8"))
+            self._deferred = ""
+        else:
+            # Blank lines only count once more content follows, which is
+            # what stripping trailing whitespace off the whole prompt means.
+            self._deferred += piece
+
+    def hexdigest(self) -> str:
+        self._emit(self._tail)
+        self._tail = ""
+        return self._hash.hexdigest()
+
+
+def prompt_digest(prompt: str) -> str:
+    """Digest a prompt into a cache key.
+
+    Trailing whitespace is stripped per line before hashing, so
+    formatting-only drift (a file gaining or losing a trailing newline)
+    still hits the cache; the prompt itself is sent unmodified. BLAKE2b is
+    noticeably faster than SHA-256 on multi-hundred-KB prompts and a 128-bit
+    digest is far more collision resistance than a cache key needs.
+    """
+    hasher = _PromptHasher()
+    hasher.update(prompt)
+    return hasher.hexdigest()
+
+
 class AnalysisCache:
-    """Simple disk cache keyed by SHA-256 of the prompt string."""
+    """Simple disk cache keyed by a prompt digest (see :func:`prompt_digest`).
 
-    def __init__(self, cache_dir: Path | None = None) -> None:
-        self._cache_dir = cache_dir or Path(".ollama_cache")
+    Callers compute the digest once and reuse it for both ``get`` and ``put``,
+    so the prompt is never re-encoded or re-hashed on the cache path. A small
+    in-memory LRU sits in front of the disk store so repeat lookups within one
+    process skip the filesystem entirely.
+    """
 
-    @staticmethod
-    def _hash(prompt: str) -> str:
-        return hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+    _MEM_MAX = 512
 
-    def get(self, prompt: str) -> str | None:
-        cache_file = self._cache_dir / (self._hash(prompt) + ".json")
-        if not cache_file.exists():
+    def __init__(self, cache_dir: Path | None = None, max_age_seconds: float | None = None) -> None:
+        self._cache_dir = cache_dir or Path(".ollama_cache")
+        self._max_age = max_age_seconds
+        self._mem: OrderedDict[str, str] = OrderedDict()
+        # One cache is shared across ollama_generate_many's worker threads,
+        # so the memory layer's check-then-act sequences need a lock.
+        self._mem_lock = threading.Lock()
+
+    def _remember(self, digest: str, response: str) -> None:
+        # The memory layer cannot observe mtime, so it is bypassed entirely
+        # when entries can expire.
+        if self._max_age is not None:
+            return
+        with self._mem_lock:
+            self._mem[digest] = response
+            self._mem.move_to_end(digest)
+            while len(self._mem) > self._MEM_MAX:
+                self._mem.popitem(last=False)
+
+    def _entry_path(self, digest: str) -> Path:
+        # Shard by the first two hex chars (git-objects layout) so no single
+        # directory grows past ~256 entries as the cache fills up.
+        return self._cache_dir / digest[:2] / (digest[2:] + ".gz")
+
+    def get(self, digest: str) -> str | None:
+        with self._mem_lock:
+            cached = self._mem.get(digest)
+            if cached is not None:
+                self._mem.move_to_end(digest)
+                return cached
+
+        cache_file = self._entry_path(digest)
+        try:
+            fd = os.open(cache_file, os.O_RDONLY)
+        except OSError:
             return None
         try:
-            data = json.loads(cache_file.read_text(encoding="utf-8"))
-            return data.get("response")
-        except (json.JSONDecodeError, OSError):
+            st = os.fstat(fd)
+            if self._max_age is not None and time.time() - st.st_mtime > self._max_age:
+                return None
+            if st.st_size == 0:
+                return None  # crash artifact; even an empty response gzips to a header
+            with mmap.mmap(fd, 0, access=mmap.ACCESS_READ) as mm:
+                response = gzip.decompress(bytes(mm)).decode("utf-8")
+        except (OSError, EOFError, UnicodeDecodeError, zlib.error):
             return None
+        finally:
+            os.close(fd)
 
-    def put(self, prompt: str, response: str) -> None:
-        self._cache_dir.mkdir(parents=True, exist_ok=True)
-        cache_file = self._cache_dir / (self._hash(prompt) + ".json")
-        cache_file.write_text(
-            json.dumps({"prompt_hash": self._hash(prompt), "response": response}),
-            encoding="utf-8",
-        )
+        self._remember(digest, response)
+        return response
+
+    def put(self, digest: str, response: str) -> None:
+        cache_file = self._entry_path(digest)
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = cache_file.with_name(cache_file.name + ".tmp")
+        tmp_file.write_bytes(gzip.compress(response.encode("utf-8")))
+        os.replace(tmp_file, cache_file)
+        self._remember(digest, response)
 
 
 # ---------------------------------------------------------------------------
@@ -162,34 +441,170 @@ class AnalysisCache:
 # ---------------------------------------------------------------------------
 
 
+def _json_loads(data: bytes | str) -> dict:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _json_dumps_bytes(obj: dict) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode("utf-8")
+
+
+_ESCAPE_CHUNK = 1 << 16
+
+
+def _encode_generate_payload(fields: dict, prompt: str) -> bytes:
+    """Encode the ``/api/generate`` body, escaping the prompt in bounded chunks.
+
+    Serialising the whole payload dict in one shot holds the prompt and its
+    escaped copy in memory at the same time; escaping slice by slice into a
+    BytesIO caps the extra allocation at one chunk. Escaping is per-character,
+    so slicing at arbitrary code-point boundaries is safe.
+    """
+    buf = io.BytesIO()
+    buf.write(b"{")
+    for key, value in fields.items():
+        buf.write(_json_dumps_bytes(key))
+        buf.write(b":")
+        buf.write(_json_dumps_bytes(value))
+        buf.write(b",")
+    buf.write(b'"prompt":"')
+    for start in range(0, len(prompt), _ESCAPE_CHUNK):
+        escaped = encode_basestring_ascii(prompt[start : start + _ESCAPE_CHUNK])
+        buf.write(escaped[1:-1].encode("ascii"))  # strip the quotes it adds
+    buf.write(b'"}')
+    return buf.getvalue()
+
+
+_SESSION: requests.Session | None = None
+_SESSION_LOCK = threading.Lock()
+
+
+def _get_session() -> requests.Session:
+    """Return the shared keep-alive session, creating it on first use.
+
+    Reusing one pooled session avoids a fresh TCP handshake per call when
+    several generations hit the same Ollama server in one process. Creation
+    is guarded by a lock so concurrent callers share a single pool.
+    """
+    global _SESSION
+    if _SESSION is None:
+        with _SESSION_LOCK:
+            if _SESSION is None:
+                # Import here so the dependency is optional at module-load time.
+                import requests
+
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                _SESSION = session
+    return _SESSION
+
+
 def ollama_generate(
     prompt: str,
     model: str,
     base_url: str,
     timeout: int = 120,
     cache: AnalysisCache | None = None,
+    stream: bool = False,
+    on_token: Callable[[str], None] | None = None,
+    digest: str | None = None,
+    keep_alive: str | None = None,
 ) -> str:
+    """Generate a completion from Ollama, optionally streaming it.
+
+    With ``stream=True`` the server sends tokens as they are produced and
+    *on_token* (if given) is invoked per fragment, so callers can surface
+    output before the full generation finishes. On a cache hit *on_token*
+    receives the whole cached response as a single fragment. Callers that
+    already hold the prompt digest (see :func:`build_prompt_keyed`) can pass
+    it to skip re-hashing the prompt.
+    """
+    if cache is not None and digest is None:
+        digest = prompt_digest(prompt)
     if cache is not None:
-        cached = cache.get(prompt)
+        cached = cache.get(digest)
         if cached is not None:
+            if on_token is not None:
+                on_token(cached)
             return cached
 
     url = base_url.rstrip("/") + "/api/generate"
-    payload = {"model": model, "prompt": prompt, "stream": False}
-    response = requests.post(url, json=payload, timeout=timeout)
+    fields: dict = {"model": model, "stream": stream}
+    if keep_alive is not None:
+        fields["keep_alive"] = keep_alive
+    response = _get_session().post(
+        url,
+        data=_encode_generate_payload(fields, prompt),
+        headers={"Content-Type": "application/json"},
+        timeout=timeout,
+        stream=stream,
+    )
     response.raise_for_status()
-    data = response.json()
-    if "response" not in data:
-        raise ValueError(f"Unexpected Ollama response: {json.dumps(data)[:200]}")
 
-    result = data["response"]
+    if stream:
+        fragments: list[str] = []
+        for line in response.iter_lines():
+            if not line:
+                continue
+            chunk = _json_loads(line)
+            if "error" in chunk:
+                raise ValueError(f"Unexpected Ollama response: {json.dumps(chunk)[:200]}")
+            fragment = chunk.get("response", "")
+            if fragment:
+                fragments.append(fragment)
+                if on_token is not None:
+                    on_token(fragment)
+            if chunk.get("done"):
+                break
+        result = "".join(fragments)
+    else:
+        # Parse the raw bytes directly; response.json() would first copy
+        # them into a str via requests' encoding detection.
+        data = _json_loads(response.content)
+        if "response" not in data:
+            raise ValueError(f"Unexpected Ollama response: {json.dumps(data)[:200]}")
+        result = data["response"]
 
     if cache is not None:
-        cache.put(prompt, result)
+        cache.put(digest, result)
 
     return result
 
 
+def ollama_generate_many(
+    prompts: list[str],
+    model: str,
+    base_url: str,
+    timeout: int = 120,
+    cache: AnalysisCache | None = None,
+    concurrency: int = 4,
+    keep_alive: str | None = "5m",
+) -> list[str]:
+    """Generate completions for several prompts concurrently.
+
+    Requests fan out over the shared connection pool up to *concurrency* at a
+    time, and ``keep_alive`` asks the server to keep the model loaded between
+    calls so only the first prompt pays the load time. Results come back in
+    prompt order; each worker goes through the normal cache path.
+    """
+    if not prompts:
+        return []
+
+    def _one(prompt: str) -> str:
+        return ollama_generate(
+            prompt, model, base_url, timeout=timeout, cache=cache, keep_alive=keep_alive
+        )
+
+    with ThreadPoolExecutor(max_workers=min(concurrency, len(prompts))) as pool:
+        return list(pool.map(_one, prompts))
+
+
 # ---------------------------------------------------------------------------
 # Gemini (google-generativeai SDK)
 # ---------------------------------------------------------------------------
@@ -234,12 +649,20 @@ class GeminiProvider:
         return text.strip()
 
 
+@lru_cache(maxsize=4)
+def _get_provider(model: str, api_key: str | None, timeout: int) -> GeminiProvider:
+    return GeminiProvider(model=model, api_key=api_key, timeout=timeout)
+
+
 def gemini_refine(
     analysis: str,
     model: str = "gemini-2.0-flash",
     api_key: str | None = None,
     timeout: int = 120,
 ) -> str:
-    """Convenience wrapper around :class:`GeminiProvider`."""
-    provider = GeminiProvider(model=model, api_key=api_key, timeout=timeout)
-    return provider.refine(analysis)
+    """Convenience wrapper around :class:`GeminiProvider`.
+
+    Providers are memoised per ``(model, api_key, timeout)`` so batch
+    refinements don't re-run SDK configuration and model construction.
+    """
+    return _get_provider(model, api_key, timeout).refine(analysis)
@@ -4,8 +4,6 @@ import argparse
 import os
 from pathlib import Path
 
-from .analysis import AnalysisCache, build_prompt, collect_files, gemini_refine, ollama_generate
-
 
 def _parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(
@@ -73,6 +71,12 @@ def _parse_args() -> argparse.Namespace:
         help="Gemini API key (or set GEMINI_API_KEY env var)",
     )
 
+    analyze.add_argument(
+        "--stream",
+        action="store_true",
+        help="Stream Ollama output to stdout as it is generated",
+    )
+
     # Caching
     analyze.add_argument(
         "--no-cache",
@@ -87,6 +91,16 @@ def run() -> int:
     args = _parse_args()
 
     if args.command == "analyze":
+        # Imported here so --help/argparse errors don't pay for the analysis
+        # module's (transitive) dependency imports.
+        from .analysis import (
+            AnalysisCache,
+            build_prompt_keyed,
+            collect_files,
+            gemini_refine,
+            ollama_generate,
+        )
+
         base_path = Path(args.path).resolve()
         include = args.include or None
         exclude = args.exclude or None
@@ -102,10 +116,26 @@ def run() -> int:
         if not files:
             raise SystemExit("No files matched. Adjust --include/--exclude.")
 
-        prompt = build_prompt(files, args.focus or None)
+        prompt, digest = build_prompt_keyed(files, args.focus or None)
 
         cache = None if args.no_cache else AnalysisCache()
-        analysis = ollama_generate(prompt, args.model, args.ollama_url, cache=cache)
+
+        # Only stream to stdout when the Ollama output is the final output;
+        # with --gemini-refine the refined text is what gets printed.
+        stream_stdout = args.stream and not args.gemini_refine
+        on_token = None
+        if stream_stdout:
+            on_token = lambda token: print(token, end="", flush=True)  # noqa: E731
+
+        analysis = ollama_generate(
+            prompt,
+            args.model,
+            args.ollama_url,
+            cache=cache,
+            stream=args.stream,
+            on_token=on_token,
+            digest=digest,
+        )
 
         if args.gemini_refine:
             analysis = gemini_refine(
@@ -114,7 +144,10 @@ def run() -> int:
                 api_key=args.gemini_api_key or None,
             )
 
-        print(analysis)
+        if stream_stdout:
+            print()
+        else:
+            print(analysis)
         return 0
 
     raise SystemExit(f"Unknown command: {args.command}")
@@ -2,7 +2,7 @@ from __future__ import annotations
 
 import json
 from pathlib import Path
-from unittest.mock import MagicMock, patch
+from unittest.mock import MagicMock
 
 import pytest
 
@@ -10,13 +10,16 @@ from gemini_ollama_bridge.analysis import (
     AnalysisCache,
     FileChunk,
     GeminiProvider,
+    _get_provider,
     build_prompt,
+    build_prompt_keyed,
     collect_files,
     gemini_refine,
     ollama_generate,
+    ollama_generate_many,
+    prompt_digest,
 )
 
-
 # ---------------------------------------------------------------------------
 # File collection
 # ---------------------------------------------------------------------------
@@ -29,7 +32,7 @@ def test_collect_files_respects_include_exclude(tmp_path: Path) -> None:
     (tmp_path / "node_modules" / "bad.js").write_text("alert(1)")
 
     files = collect_files(tmp_path, include=["**/*.py", "**/*.txt"], exclude=["*.txt"])
-    assert [f.path.name for f in files] == ["keep.py"]
+    assert [Path(f.path).name for f in files] == ["keep.py"]
 
 
 def test_collect_files_skips_large_files(tmp_path: Path) -> None:
@@ -39,7 +42,7 @@ def test_collect_files_skips_large_files(tmp_path: Path) -> None:
     big.write_text("x" * 200_000)
 
     files = collect_files(tmp_path, include=["**/*.py"], max_file_bytes=1_000)
-    names = [f.path.name for f in files]
+    names = [Path(f.path).name for f in files]
     assert "small.py" in names
     assert "big.py" not in names
 
@@ -67,12 +70,60 @@ def test_collect_files_excludes_default_dirs(tmp_path: Path) -> None:
     (tmp_path / "real.py").write_text("print(1)")
 
     files = collect_files(tmp_path, include=["**/*.py"])
-    names = [f.path.name for f in files]
+    names = [Path(f.path).name for f in files]
     assert "real.py" in names
     assert "config.py" not in names
     assert "mod.py" not in names
 
 
+def test_collect_files_skips_directory_symlinks(tmp_path: Path) -> None:
+    (tmp_path / "real.py").write_text("print(1)")
+    (tmp_path / "target_dir").mkdir()
+    (tmp_path / "weird.py").symlink_to(tmp_path / "target_dir")
+    (tmp_path / "gone.py").symlink_to(tmp_path / "missing")
+
+    files = collect_files(tmp_path, include=["**/*.py"], exclude=["target_dir"])
+    assert [f.path for f in files] == ["real.py"]
+
+
+def test_collect_files_memoize_skips_rewalk(
+    monkeypatch: pytest.MonkeyPatch, tmp_path: Path
+) -> None:
+    (tmp_path / "a.py").write_text("x = 1")
+
+    first = collect_files(tmp_path, include=["**/*.py"], memoize=True)
+    assert [f.path for f in first] == ["a.py"]
+
+    # An unchanged tree must be served from the memo without walking again
+    def exploding_walk(*args):
+        raise AssertionError("tree was re-walked")
+
+    monkeypatch.setattr("gemini_ollama_bridge.analysis._walk", exploding_walk)
+    second = collect_files(tmp_path, include=["**/*.py"], memoize=True)
+    assert second == first
+
+
+def test_collect_files_literal_includes_skip_the_walk(tmp_path: Path) -> None:
+    (tmp_path / "src").mkdir()
+    (tmp_path / "src" / "a.py").write_text("x = 1")
+    (tmp_path / "b.py").write_text("y = 2")
+
+    files = collect_files(tmp_path, include=["src/a.py"])
+    assert [f.path for f in files] == ["src/a.py"]
+
+
+def test_collect_files_literal_includes_stay_inside_base(tmp_path: Path) -> None:
+    outside = tmp_path / "outside.txt"
+    outside.write_text("secret")
+    base = tmp_path / "base"
+    base.mkdir()
+    (base / "a.py").write_text("x = 1")
+
+    # Absolute and parent-traversal includes match nothing, same as globs
+    assert collect_files(base, include=[str(outside)]) == []
+    assert collect_files(base, include=["../outside.txt"]) == []
+
+
 # ---------------------------------------------------------------------------
 # Prompt building
 # ---------------------------------------------------------------------------
@@ -91,7 +142,7 @@ def test_build_prompt_contains_focus_and_files(tmp_path: Path) -> None:
 
 
 def test_build_prompt_without_focus() -> None:
-    chunks = [FileChunk(path=Path("a.py"), content="pass")]
+    chunks = [FileChunk(path="a.py", content="pass")]
     prompt = build_prompt(chunks, focus=None)
     assert "Focus on" not in prompt
     assert "File: a.py" in prompt
@@ -100,8 +151,8 @@ def test_build_prompt_without_focus() -> None:
 
 def test_build_prompt_multiple_files() -> None:
     chunks = [
-        FileChunk(path=Path("a.py"), content="import os"),
-        FileChunk(path=Path("b.js"), content="console.log(1)"),
+        FileChunk(path="a.py", content="import os"),
+        FileChunk(path="b.js", content="console.log(1)"),
     ]
     prompt = build_prompt(chunks, focus="performance")
     assert "File: a.py" in prompt
@@ -115,23 +166,39 @@ def test_build_prompt_multiple_files() -> None:
 # ---------------------------------------------------------------------------
 
 
+def _patch_session(monkeypatch: pytest.MonkeyPatch, post) -> None:
+    """Route ollama_generate's pooled session at a fake post callable."""
+
+    class _Session:
+        def post(self, url: str, **kwargs):
+            return post(url, **kwargs)
+
+    monkeypatch.setattr("gemini_ollama_bridge.analysis._get_session", lambda: _Session())
+
+
+def _sent_payload(kwargs: dict) -> dict:
+    """Decode the request payload whether it was sent as json= or data=."""
+    if kwargs.get("json") is not None:
+        return kwargs["json"]
+    return json.loads(kwargs["data"])
+
+
 def test_ollama_generate_uses_endpoint(monkeypatch: pytest.MonkeyPatch) -> None:
     class DummyResponse:
+        content = json.dumps({"response": "ok"}).encode()
+
         def raise_for_status(self) -> None:
             return None
 
-        def json(self) -> dict[str, str]:
-            return {"response": "ok"}
-
     captured: dict = {}
 
-    def fake_post(url: str, json: dict, timeout: int) -> DummyResponse:
+    def fake_post(url: str, **kwargs) -> DummyResponse:
         captured["url"] = url
-        captured["json"] = json
-        captured["timeout"] = timeout
+        captured["json"] = _sent_payload(kwargs)
+        captured["timeout"] = kwargs.get("timeout")
         return DummyResponse()
 
-    monkeypatch.setattr("requests.post", fake_post)
+    _patch_session(monkeypatch, fake_post)
 
     result = ollama_generate("hello", "llama3.1", "http://localhost:11434")
 
@@ -142,16 +209,15 @@ def test_ollama_generate_uses_endpoint(monkeypatch: pytest.MonkeyPatch) -> None:
 
 def test_ollama_generate_raises_on_unexpected_response(monkeypatch: pytest.MonkeyPatch) -> None:
     class DummyResponse:
+        content = json.dumps({"error": "something went wrong"}).encode()
+
         def raise_for_status(self) -> None:
             return None
 
-        def json(self) -> dict:
-            return {"error": "something went wrong"}
-
-    def fake_post(url: str, json: dict, timeout: int) -> DummyResponse:
+    def fake_post(url: str, **kwargs) -> DummyResponse:
         return DummyResponse()
 
-    monkeypatch.setattr("requests.post", fake_post)
+    _patch_session(monkeypatch, fake_post)
 
     with pytest.raises(ValueError, match="Unexpected Ollama response"):
         ollama_generate("hello", "llama3.1", "http://localhost:11434")
@@ -161,18 +227,17 @@ def test_ollama_generate_with_cache(monkeypatch: pytest.MonkeyPatch, tmp_path: P
     call_count = 0
 
     class DummyResponse:
+        content = json.dumps({"response": "generated"}).encode()
+
         def raise_for_status(self) -> None:
             return None
 
-        def json(self) -> dict[str, str]:
-            return {"response": "generated"}
-
-    def fake_post(url: str, json: dict, timeout: int) -> DummyResponse:
+    def fake_post(url: str, **kwargs) -> DummyResponse:
         nonlocal call_count
         call_count += 1
         return DummyResponse()
 
-    monkeypatch.setattr("requests.post", fake_post)
+    _patch_session(monkeypatch, fake_post)
 
     cache = AnalysisCache(cache_dir=tmp_path / "cache")
 
@@ -194,22 +259,79 @@ def test_ollama_generate_with_cache(monkeypatch: pytest.MonkeyPatch, tmp_path: P
 
 def test_ollama_generate_without_cache(monkeypatch: pytest.MonkeyPatch) -> None:
     class DummyResponse:
+        content = json.dumps({"response": "no-cache"}).encode()
+
         def raise_for_status(self) -> None:
             return None
 
-        def json(self) -> dict[str, str]:
-            return {"response": "no-cache"}
-
-    def fake_post(url: str, json: dict, timeout: int) -> DummyResponse:
+    def fake_post(url: str, **kwargs) -> DummyResponse:
         return DummyResponse()
 
-    monkeypatch.setattr("requests.post", fake_post)
+    _patch_session(monkeypatch, fake_post)
 
     # Passing cache=None should still work fine
     result = ollama_generate("hello", "llama3.1", "http://localhost:11434", cache=None)
     assert result == "no-cache"
 
 
+def test_ollama_generate_streams_fragments(monkeypatch: pytest.MonkeyPatch) -> None:
+    lines = [
+        json.dumps({"response": "Hello "}).encode(),
+        b"",  # keep-alive blank line is skipped
+        json.dumps({"response": "world"}).encode(),
+        json.dumps({"done": True}).encode(),
+    ]
+
+    class DummyResponse:
+        def raise_for_status(self) -> None:
+            return None
+
+        def iter_lines(self):
+            yield from lines
+
+    captured: dict = {}
+
+    def fake_post(url: str, **kwargs) -> DummyResponse:
+        captured["json"] = _sent_payload(kwargs)
+        captured["stream"] = kwargs.get("stream")
+        return DummyResponse()
+
+    _patch_session(monkeypatch, fake_post)
+
+    tokens: list[str] = []
+    result = ollama_generate(
+        "hello", "llama3.1", "http://localhost:11434", stream=True, on_token=tokens.append
+    )
+
+    assert result == "Hello world"
+    assert tokens == ["Hello ", "world"]
+    assert captured["json"]["stream"] is True
+    assert captured["stream"] is True
+
+
+def test_ollama_generate_many_preserves_order(monkeypatch: pytest.MonkeyPatch) -> None:
+    payloads: list[dict] = []
+
+    class DummyResponse:
+        def __init__(self, prompt: str) -> None:
+            self.content = json.dumps({"response": prompt.upper()}).encode()
+
+        def raise_for_status(self) -> None:
+            return None
+
+    def fake_post(url: str, **kwargs) -> DummyResponse:
+        payload = _sent_payload(kwargs)
+        payloads.append(payload)
+        return DummyResponse(payload["prompt"])
+
+    _patch_session(monkeypatch, fake_post)
+
+    results = ollama_generate_many(["a", "b", "c"], "llama3.1", "http://localhost:11434")
+
+    assert results == ["A", "B", "C"]
+    assert all(p["keep_alive"] == "5m" for p in payloads)
+
+
 # ---------------------------------------------------------------------------
 # AnalysisCache
 # ---------------------------------------------------------------------------
@@ -235,17 +357,68 @@ def test_cache_different_prompts(tmp_path: Path) -> None:
 
 
 def test_cache_handles_corrupt_file(tmp_path: Path) -> None:
+    digest = prompt_digest("prompt")
     cache = AnalysisCache(cache_dir=tmp_path / "cache")
-    cache.put("prompt", "response")
+    cache.put(digest, "response")
 
-    # Corrupt the cache file
-    import hashlib
+    # Corrupt the cache file with bytes that do not decode as UTF-8
+    cache_file = tmp_path / "cache" / digest[:2] / (digest[2:] + ".gz")
+    cache_file.write_bytes(b"\xff\xfe\xfd garbage")
 
-    h = hashlib.sha256("prompt".encode()).hexdigest()
-    cache_file = tmp_path / "cache" / (h + ".json")
-    cache_file.write_text("not valid json", encoding="utf-8")
+    # A fresh instance (e.g. another process) must treat the entry as a miss
+    fresh = AnalysisCache(cache_dir=tmp_path / "cache")
+    assert fresh.get(digest) is None
 
-    assert cache.get("prompt") is None
+    # Same contract for a valid entry truncated mid-stream (gzip raises
+    # EOFError here rather than BadGzipFile)
+    cache.put(digest, "response")
+    cache_file.write_bytes(cache_file.read_bytes()[:-4])
+    fresh = AnalysisCache(cache_dir=tmp_path / "cache")
+    assert fresh.get(digest) is None
+
+
+def test_prompt_digest_ignores_trailing_whitespace() -> None:
+    assert prompt_digest("x = 1\n") == prompt_digest("x = 1")
+    assert prompt_digest("a  \nb") == prompt_digest("a\nb")
+    assert prompt_digest("a\nb") != prompt_digest("a b")
+
+
+def test_build_prompt_keyed_matches_one_shot_digest() -> None:
+    chunks = [
+        FileChunk(path="a.py", content="x = 1   \n\n\n"),
+        FileChunk(path="b.py", content="y = 2"),
+    ]
+    prompt, digest = build_prompt_keyed(chunks, focus="bugs")
+    assert prompt == build_prompt(chunks, focus="bugs")
+    assert digest == prompt_digest(prompt)
+
+
+def test_cache_serves_hot_entries_from_memory(tmp_path: Path) -> None:
+    import shutil
+
+    digest = prompt_digest("prompt")
+    cache = AnalysisCache(cache_dir=tmp_path / "cache")
+    cache.put(digest, "response")
+
+    # Removing the disk entries proves the repeat lookup never touches them
+    shutil.rmtree(tmp_path / "cache")
+    assert cache.get(digest) == "response"
+
+
+def test_cache_expires_old_entries(tmp_path: Path) -> None:
+    import os
+    import time
+
+    digest = prompt_digest("prompt")
+    cache = AnalysisCache(cache_dir=tmp_path / "cache", max_age_seconds=60)
+    cache.put(digest, "response")
+    assert cache.get(digest) == "response"
+
+    # Age the entry past the TTL
+    cache_file = tmp_path / "cache" / digest[:2] / (digest[2:] + ".gz")
+    old = time.time() - 120
+    os.utime(cache_file, (old, old))
+    assert cache.get(digest) is None
 
 
 # ---------------------------------------------------------------------------
@@ -281,6 +454,7 @@ def test_gemini_refine_calls_sdk(monkeypatch: pytest.MonkeyPatch) -> None:
 
     saved = sys.modules.get("google.generativeai")
     sys.modules["google.generativeai"] = mock_genai
+    _get_provider.cache_clear()  # memoised providers would leak across tests
     try:
         result = gemini_refine(
             analysis="raw analysis",
@@ -315,6 +489,7 @@ def test_gemini_refine_raises_on_empty_output(monkeypatch: pytest.MonkeyPatch) -
 
     saved = sys.modules.get("google.generativeai")
     sys.modules["google.generativeai"] = mock_genai
+    _get_provider.cache_clear()  # memoised providers would leak across tests
     try:
         with pytest.raises(RuntimeError, match="Gemini returned empty output"):
             gemini_refine(
@@ -339,16 +514,15 @@ def test_full_pipeline_without_gemini(monkeypatch: pytest.MonkeyPatch, tmp_path:
     (tmp_path / "app.py").write_text("def main():\n    pass\n")
 
     class DummyResponse:
+        content = json.dumps({"response": "## No issues found\nCode looks clean."}).encode()
+
         def raise_for_status(self) -> None:
             return None
 
-        def json(self) -> dict[str, str]:
-            return {"response": "## No issues found\nCode looks clean."}
-
-    def fake_post(url: str, json: dict, timeout: int) -> DummyResponse:
+    def fake_post(url: str, **kwargs) -> DummyResponse:
         return DummyResponse()
 
-    monkeypatch.setattr("requests.post", fake_post)
+    _patch_session(monkeypatch, fake_post)
 
     files = collect_files(tmp_path, include=["**/*.py"])
     assert len(files) == 1
@@ -369,18 +543,17 @@ def test_full_pipeline_with_caching(monkeypatch: pytest.MonkeyPatch, tmp_path: P
     call_count = 0
 
     class DummyResponse:
+        content = json.dumps({"response": "analysis result"}).encode()
+
         def raise_for_status(self) -> None:
             return None
 
-        def json(self) -> dict[str, str]:
-            return {"response": "analysis result"}
-
-    def fake_post(url: str, json: dict, timeout: int) -> DummyResponse:
+    def fake_post(url: str, **kwargs) -> DummyResponse:
         nonlocal call_count
         call_count += 1
         return DummyResponse()
 
-    monkeypatch.setattr("requests.post", fake_post)
+    _patch_session(monkeypatch, fake_post)
 
     cache = AnalysisCache(cache_dir=tmp_path / ".cache")
     files = collect_files(tmp_path / "src", include=["**/*.py"])